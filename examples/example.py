@@ -29,23 +29,22 @@ def wireworld():
     the Wire World automaton, demonstrating use of the 
     vivludo.automata.NonTotalistic class. '''
 
-    # Define a function which takes a 3x3 array, representing a cell and its
-    # neighbourhood, as inputs, and returns the new state for the cell:
-    def rule(input_array):
+    # Define a function which takes an array of 3x3 arrays (of shape (N,3,3)),
+    # each representing a cell and its neighbourhood, and returns an array of
+    # the N new states for those cells.  (A function taking a single 3x3 array
+    # and returning a single state also works, without batched=True, but is
+    # much slower to precompute.)
+    def rule(nbhds):
         # 0 = dead, 1 = conductor, 2 = electron head, 3 = electron tail
-        cell = input_array[1,1]
-        if cell == 0:
-            return 0
-        elif cell == 2:
-            return 3
-        elif cell == 3:
-            return 1
-        else:
-            heads = [x for x in input_array.reshape(9) if x == 2]
-            elec = len(heads) == 1 or len(heads) == 2
-            return 2 if elec else 1
+        cells = nbhds[:,1,1]
+        heads = (nbhds == 2).sum(axis=(1,2))
+        elec = (cells == 1) & ((heads == 1) | (heads == 2))
+        # Dead cells and conductors without electrons are unchanged.
+        return np.select([cells == 2, cells == 3, elec],[3, 1, 2],
+            default=cells)
     # Pass this update rule function into the NonTotalistic constructor:
-    ww = NonTotalistic(rule,base=4,nb="moore",edges="fixed",edge_fill=0)
+    ww = NonTotalistic(rule,base=4,nb="moore",edges="fixed",edge_fill=0,
+        batched=True)
     # Define an initial state for the automaton (a simple clock & diodes):
     pattern = [[0,0,0,0,0,0,0,0,0,0,0],
               [0,0,0,0,0,0,1,1,0,0,0],
@@ -73,16 +72,14 @@ def wireworld():
 def brians_brain():
     ''' Create a gif of the Brian's Brain automaton, further demonstrating
     use of the vivludo.automata.NonTotalistic class. '''
-    def rule(input_array):
+    def rule(nbhds):
         # 0 = dead, 1 = alive, 2 = dying
-        cell = input_array[1,1]
-        if cell == 1:
-            return 2
-        if cell == 2:
-            return 0
-        living_neighbours = len([x for x in input_array.reshape(9) if x == 1])
-        return 1 if living_neighbours == 2 else 0
-    bb = NonTotalistic(rule,base=4,nb="moore",edges="wrap",edge_fill=0)
+        cells = nbhds[:,1,1]
+        living_neighbours = (nbhds == 1).sum(axis=(1,2))
+        return np.select([cells == 1, cells == 2, living_neighbours == 2],
+            [2, 0, 1], default=0)
+    bb = NonTotalistic(rule,base=4,nb="moore",edges="wrap",edge_fill=0,
+        batched=True)
     bb.set_state(np.random.randint(0,3,100*100).reshape(100,100))
     make_gif(bb,300,colors=3, frame_duration=0.1, 
         filename="images/brians_brain.gif", scale=2)
@@ -102,15 +99,13 @@ def rule110():
 def anneal():
     ann = LifeLike("B4678/S35678",edges="wrap")
     ann.set_state(np.random.randint(0,2,500*500).reshape(500,500))
-    for i in range(50):
-        ann.step()
+    ann.run(50)
     save_image(ann.copy_state(),colors=2,filename="images/anneal.png")
 
 def majority_vote():
     vote = LifeLike("B5678/S45678",edges="wrap")
     vote.set_state(np.random.randint(0,2,500*500).reshape(500,500))
-    for i in range(100):
-        vote.step()
+    vote.run(100)
     save_image(vote.copy_state(),colors=[[100,0,120],[150,0,170]],
         filename="images/majority_vote.png")
 
@@ -15,9 +15,11 @@ setup(name="vivludo",
       url="https://github.com/averyhiebert/vivludo",
       install_requires=[
         "numpy",
-        "scipy",
         "imageio"
       ],
+      extras_require={
+        "fast": ["numba"]
+      },
       classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
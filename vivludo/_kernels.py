@@ -0,0 +1,122 @@
+''' Numba-compiled kernels used to speed up the automata in vivludo.automata.
+
+This module requires numba, which is an optional dependency.  If it can't be
+imported, the automata fall back to slower pure numpy implementations.'''
+import numpy as np
+from numba import njit, prange, uint64
+
+# Note: these kernels compute the same thing as
+#  update_array[convolve2d(cell, kernel, mode="same", ...)], but fuse the
+#  convolution and the lookup into a single pass, without allocating an
+#  intermediate array.  The kernel is given as an array of taps, each row of
+#  which is (di, dj, weight), meaning that cell (i+di, j+dj) contributes
+#  weight times its value to the sum for cell (i, j).  Zero weights are left
+#  out, so e.g. the Von Neumann neighbourhood only needs 5 taps.
+#
+#  The state is given as a padded array, with the grid itself starting at row
+#  top and column left, surrounded by a halo wide enough for every tap, which
+#  the caller is responsible for filling in (by wrapping or with a constant).
+#  This means the kernels never need to check for the edges of the grid.
+#
+#  The grid is traversed in tiles of TILE_H rows by TILE_W columns, so that the
+#  rows of state needed for a tile stay in the L1 cache while it is computed.
+#  (With a 3x3 kernel and 1-byte cells, a tile reads (TILE_H+2)*(TILE_W+2)
+#  bytes of state and writes TILE_H*TILE_W bytes, about 33KB in total.)
+#  If the update array itself is too large to stay in cache (e.g. base 4 with
+#  the Moore neighbourhood), a Morton-order traversal might help further.
+TILE_H = 64
+TILE_W = 256
+
+@njit(cache=True)
+def _add_taps(padded, taps, i, j0, n, acc):
+    ''' Set acc[k] to the weighted sum for padded cell (i, j0 + k), for k from
+    0 up to (but not including) n.
+
+    The sums are built up one tap at a time, so that the inner loop runs over
+    contiguous memory and can be vectorized.  (Unsigned indices are used there
+    since numba's handling of negative indices otherwise prevents this.)'''
+    acc[:n] = 0
+    for t in range(taps.shape[0]):
+        w = acc.dtype.type(taps[t,2])
+        row = padded[i + taps[t,0]]
+        start = uint64(j0 + taps[t,1])
+        for k in range(uint64(0), uint64(n)):
+            acc[k] += w*row[start + k]
+
+@njit(parallel=True, cache=True, fastmath=True)
+def step(padded, top, left, H, W, taps, update_array, out):
+    ''' Perform one step of a convolutional automaton on the H x W grid at
+    (top, left) in padded, writing the result into the same place in out.'''
+    for tile in prange((H + TILE_H - 1)//TILE_H):
+        acc = np.empty(TILE_W, dtype=np.int32)
+        i0 = top + tile*TILE_H
+        for j0 in range(left, left + W, TILE_W):
+            n = min(TILE_W, left + W - j0)
+            for i in range(i0, min(i0 + TILE_H, top + H)):
+                _add_taps(padded, taps, i, j0, n, acc)
+                out_row = out[i]
+                for k in range(uint64(0), uint64(n)):
+                    out_row[uint64(j0) + k] = update_array[acc[k]]
+
+# Template for rule-specific Lifelike kernels (see lifelike_step).  Neighbour
+#  counts are computed with every tap unrolled, and the rule is inlined as a
+#  chain of comparisons instead of being looked up in an update array.
+_LIFELIKE_TEMPLATE = """
+def step(padded, top, left, H, W, out):
+    for tile in prange((H + TILE_H - 1)//TILE_H):
+        i0 = top + tile*TILE_H
+        for j0 in range(left, left + W, TILE_W):
+            n = uint64(min(TILE_W, left + W - j0))
+{cols}
+            for i in range(i0, min(i0 + TILE_H, top + H)):
+{rows}
+                out_row = out[i]
+                for k in range(uint64(0), n):
+                    n_alive = ({total})
+                    if row_0[s_0 + k]:
+                        out_row[s_0 + k] = {survive}
+                    else:
+                        out_row[s_0 + k] = {born}
+"""
+
+_lifelike_steps = {}
+
+def _offset_name(d):
+    return "m%d" % -d if d < 0 else "%d" % d if d == 0 else "p%d" % d
+
+def _rule_expression(counts):
+    if not counts:
+        return "0"
+    return "1 if (%s) else 0" % " or ".join("n_alive == %d" % n
+        for n in counts)
+
+def lifelike_step(born, survive, r):
+    ''' Return a compiled function step(padded, top, left, H, W, out)
+    computing one generation of the Lifelike automaton with the given birth and
+    survival counts in the Moore neighbourhood of radius r, with the same
+    conventions as step above.
+
+    Since the generated code can't be cached on disk by numba, compiled
+    functions are kept for the rest of the session instead.'''
+    key = (tuple(born), tuple(survive), r)
+    if key not in _lifelike_steps:
+        offsets = range(-r, r + 1)
+        # (Offsets are all converted to unsigned, as in _add_taps.)
+        cols = ["s_%s = uint64(j0 + %d)" % (_offset_name(d), d)
+            for d in offsets]
+        rows = ["row_%s = padded[i + %d]" % (_offset_name(d), d)
+            for d in offsets]
+        taps = ["row_%s[s_%s + k]" % (_offset_name(di), _offset_name(dj))
+            for di in offsets for dj in offsets if (di, dj) != (0, 0)]
+        source = _LIFELIKE_TEMPLATE.format(
+            cols="\n".join(" "*12 + line for line in cols),
+            rows="\n".join(" "*16 + line for line in rows),
+            total=("\n" + " "*24 + "+ ").join(taps),
+            survive=_rule_expression(survive),
+            born=_rule_expression(born))
+        namespace = {"prange": prange, "uint64": uint64,
+            "TILE_H": TILE_H, "TILE_W": TILE_W}
+        exec(source, namespace)
+        _lifelike_steps[key] = njit(parallel=True, fastmath=True)(
+            namespace["step"])
+    return _lifelike_steps[key]
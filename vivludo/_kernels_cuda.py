@@ -0,0 +1,52 @@
+''' CUDA kernels for running convolutional automata on the GPU.
+
+This module requires numba and a CUDA-capable GPU, and is only imported when
+an automaton is created with device="cuda".'''
+from numba import cuda, int32
+
+# Each block of BLOCK x BLOCK threads computes a BLOCK x BLOCK tile of cells,
+#  first loading that tile plus a halo of up to MAX_HALO cells on each side
+#  into shared memory.  Kernels reaching further than MAX_HALO aren't supported.
+BLOCK = 16
+MAX_HALO = 2
+TILE = BLOCK + 2*MAX_HALO
+
+@cuda.jit
+def step_kernel(cell, taps, update_array, wrap, fill, out):
+    ''' Perform one step of a convolutional automaton, writing the result into
+    out.  See vivludo._kernels for the meaning of the arguments.'''
+    H, W = cell.shape
+    tile = cuda.shared.array((TILE, TILE), dtype=int32)
+    ty = cuda.threadIdx.y
+    tx = cuda.threadIdx.x
+    i0 = cuda.blockIdx.y*BLOCK - MAX_HALO
+    j0 = cuda.blockIdx.x*BLOCK - MAX_HALO
+    # Every thread loads one or two cells of the tile and its halo.
+    for k in range(ty*BLOCK + tx, TILE*TILE, BLOCK*BLOCK):
+        ii = i0 + k // TILE
+        jj = j0 + k % TILE
+        if wrap:
+            tile[k // TILE, k % TILE] = cell[ii % H, jj % W]
+        elif 0 <= ii < H and 0 <= jj < W:
+            tile[k // TILE, k % TILE] = cell[ii,jj]
+        else:
+            tile[k // TILE, k % TILE] = fill
+    cuda.syncthreads()
+
+    i = i0 + MAX_HALO + ty
+    j = j0 + MAX_HALO + tx
+    if i >= H or j >= W:
+        return
+    acc = 0
+    for t in range(taps.shape[0]):
+        acc += taps[t,2]*tile[MAX_HALO + ty + taps[t,0],
+            MAX_HALO + tx + taps[t,1]]
+    out[i,j] = update_array[acc]
+
+def step(cell, taps, update_array, wrap, fill, out):
+    ''' Launch step_kernel over the whole grid (all arrays should already be
+    on the device).'''
+    H, W = cell.shape
+    blocks = ((W + BLOCK - 1)//BLOCK, (H + BLOCK - 1)//BLOCK)
+    step_kernel[blocks, (BLOCK, BLOCK)](cell, taps, update_array,
+        wrap, fill, out)
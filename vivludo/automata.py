@@ -1,14 +1,16 @@
 ''' Defines a Cellular Automaton class and a couple of likely subclasses.'''
 import re
-import warnings
-# Ignore benign warning from scipy
-warnings.filterwarnings("ignore", message="numpy.dtype size changed")
 
 import numpy as np
-from scipy.signal import convolve2d
 
 import vivludo.utils as utils
 
+# Numba is optional; without it we fall back to a numpy implementation.
+try:
+    import vivludo._kernels as _kernels
+except ImportError:
+    _kernels = None
+
 class ConvCA():
     ''' Fairly fast way of implementing many 2d automata, using convolution.
     
@@ -16,35 +18,207 @@ class ConvCA():
     compute one generation of the automaton, the array representing the
     automaton state is convolved with the given kernel to give an
     intermediate array, and then each cell's intermediate value is used to 
-    look up its final value in the update array.'''
-    def __init__(self, update_array, kernel, edges="wrap",edge_fill=0):
-        ''' Specify the precomputed update array and the integer kernel.'''
+    look up its final value in the update array.
+
+    Note that cell_array is a view into one of two buffers that step
+    alternates between, so its contents will be overwritten two steps later.
+    Use copy_state to keep a state around.'''
+    def __init__(self, update_array, kernel, edges="wrap",edge_fill=0,
+            device="cpu"):
+        ''' Specify the precomputed update array and the integer kernel.
+
+        Set device="cuda" to run the automaton on the GPU (this requires
+        numba and a CUDA-capable GPU).  The state then stays in GPU memory,
+        and is only copied back by copy_state.'''
         # Should probably do some type checking.
         if edges not in ["wrap","fixed"]:
             raise ValueError("Invalid edge mode: %s" % edges)
-        if edges == "wrap":
-            self.convolve_boundary = "wrap"
-        elif edges == "fixed":
-            self.convolve_boundary = "fill"
-        self.update_array = update_array
-        self.kernel = kernel
+        if device not in ["cpu","cuda"]:
+            raise ValueError("Invalid device: %s" % device)
+        update_array = np.asarray(update_array)
+        kernel = np.asarray(kernel)
+        # Find the largest state for which every weighted sum is still an
+        #  index into the update array.  The compiled kernels don't bounds
+        #  check their lookups, so states are limited to this range, and the
+        #  update array must not produce any state outside it.
+        if kernel.min() < 0:
+            self._max_state = 0
+        elif kernel.sum() == 0:
+            self._max_state = int(update_array.max())
+        else:
+            self._max_state = (len(update_array) - 1)//int(kernel.sum())
+        if update_array.min() < 0:
+            raise ValueError("Invalid update array entry: %s"
+                % update_array.min())
+        if update_array.max() > self._max_state:
+            raise ValueError("Invalid update array entry: %s"
+                % update_array.max())
+        # The edge fill is copied into the halo around the state (see
+        #  set_state), so it must be a valid state too.
+        if not 0 <= edge_fill <= self._max_state:
+            raise ValueError("Invalid edge fill: %s" % edge_fill)
+        # Use the smallest dtype that can hold every state (usually uint8).
+        self.update_array = update_array.astype(
+            np.min_scalar_type(self._max_state))
+        # Every convolution result is an index into the update array, so the
+        #  accumulator (and kernel) only needs to be able to hold its length.
+        self._acc_dtype = np.promote_types(
+            np.min_scalar_type(-len(update_array)), np.int16)
+        self.kernel = kernel.astype(self._acc_dtype)
+        # Precompute the nonzero taps of the kernel as (di, dj, weight),
+        #  meaning that cell (i+di, j+dj) contributes weight times its value
+        #  to the sum for cell (i, j).  This matches convolve2d with "same".
+        kh, kw = self.kernel.shape
+        ch, cw = (kh - 1)//2, (kw - 1)//2
+        self._taps = [(ch - m, cw - n, self.kernel[m,n])
+            for m, n in zip(*np.nonzero(self.kernel))]
+        # The same taps as an array, for the compiled kernels.
+        self._tap_offsets = np.array(self._taps,dtype=np.int64).reshape(-1,3)
+        self._pad_width = ((kh - 1 - ch, ch), (kw - 1 - cw, cw))
         self.edges = edges
         self.edge_fill = edge_fill
+        self.device = device
         self.cell_array = None
+        self._out = None
+        self._padded = None
+        self._padded_out = None
+        self._acc = None
+        self._acc_tmp = None
+        self._cuda_kernels = None
+        self._cuda_args = None
+        if device == "cuda":
+            import vivludo._kernels_cuda as kernels_cuda
+            reach = np.abs(self._tap_offsets[:,:2]).max(initial=0)
+            if reach > kernels_cuda.MAX_HALO:
+                raise ValueError("Kernel is too large for device='cuda'")
+            self._cuda_kernels = kernels_cuda
+            to_device = kernels_cuda.cuda.to_device
+            self._cuda_args = (to_device(self._tap_offsets),
+                to_device(self.update_array))
 
     def step(self):
         ''' Perform one step of the automaton. '''
-        self.cell_array = self.update_array[convolve2d(self.cell_array,
-            self.kernel, boundary=self.convolve_boundary,
-            fillvalue=self.edge_fill, mode="same")]
+        if self.device == "cuda":
+            taps, update_array = self._cuda_args
+            self._cuda_kernels.step(self.cell_array, taps, update_array,
+                self.edges == "wrap", self.edge_fill, self._out)
+            self.cell_array, self._out = self._out, self.cell_array
+            return
+        self._refresh_halo()
+        if _kernels is None:
+            self._step_numpy()
+            return
+        H, W = self.cell_array.shape
+        top, left = self._pad_width[0][0], self._pad_width[1][0]
+        _kernels.step(self._padded, top, left, H, W, self._tap_offsets,
+            self.update_array, self._padded_out)
+        self._swap_buffers()
+
+    def _step_numpy(self):
+        ''' Perform one step of the automaton without numba, by adding up
+        shifted slices of the padded state.'''
+        H, W = self.cell_array.shape
+        top, left = self._pad_width[0][0], self._pad_width[1][0]
+        # Accumulate into buffers that are kept between steps.
+        if self._acc is None:
+            self._acc = np.empty((H, W), dtype=self._acc_dtype)
+            self._acc_tmp = np.empty_like(self._acc)
+        acc = self._acc
+        acc[...] = 0
+        for di, dj, w in self._taps:
+            shifted = self._padded[top + di:top + di + H,
+                left + dj:left + dj + W]
+            if w == 1:
+                np.add(acc, shifted, out=acc)
+            else:
+                np.multiply(shifted, w, out=self._acc_tmp)
+                np.add(acc, self._acc_tmp, out=acc)
+        # Look up the new states directly into the spare buffer.  Every sum is
+        #  a valid index, since set_state and __init__ already checked that
+        #  all states are in range, so clipping never actually changes one.
+        #  (mode="raise" would make np.take buffer its output internally.)
+        np.take(self.update_array, acc, out=self._out, mode="clip")
+        self._swap_buffers()
+
+    def _swap_buffers(self):
+        ''' Make the output of the last step the current state, and reuse
+        the old state's buffer for the next output.'''
+        self._padded, self._padded_out = self._padded_out, self._padded
+        self.cell_array, self._out = self._out, self.cell_array
+
+    def _refresh_halo(self):
+        ''' Copy the edges of the current state into the halo around it, if
+        the edges wrap.  (With fixed edges the halo always holds edge_fill.)'''
+        if self.edges != "wrap":
+            return
+        H, W = self.cell_array.shape
+        (top, bottom), (left, right) = self._pad_width
+        padded = self._padded
+        # Do the columns first, so that copying whole rows fills the corners.
+        rows = slice(top, top + H)
+        padded[rows,:left] = padded[rows,self._halo_cols[0]]
+        padded[rows,left + W:left + W + right] = \
+            padded[rows,self._halo_cols[1]]
+        padded[:top] = padded[self._halo_rows[0]]
+        padded[top + H:top + H + bottom] = padded[self._halo_rows[1]]
+
+    def _check_states(self, cell_array):
+        ''' Return cell_array as an array, after checking that every state is
+        in range (see __init__).'''
+        cell_array = np.asarray(cell_array)
+        if cell_array.size and cell_array.min() < 0:
+            raise ValueError("Invalid state: %s" % cell_array.min())
+        if cell_array.size and cell_array.max() > self._max_state:
+            raise ValueError("Invalid state: %s" % cell_array.max())
+        return cell_array
 
     def set_state(self, cell_array):
         '''Set the state of the cellular automaton to match the given array.'''
-        self.cell_array = np.copy(cell_array)
+        cell_array = self._check_states(cell_array)
+        # Store states with the same dtype as the update array, since every
+        #  later state will be looked up from it anyway.
+        cell_array = cell_array.astype(self.update_array.dtype, copy=False)
+        # Only needed without numba, so allocated by _step_numpy if necessary.
+        self._acc = None
+        self._acc_tmp = None
+        if self.device == "cuda":
+            cuda = self._cuda_kernels.cuda
+            self.cell_array = cuda.to_device(np.ascontiguousarray(cell_array))
+            self._out = cuda.device_array_like(self.cell_array)
+            return
+
+        # The state is kept in the interior of a larger buffer, surrounded by
+        #  a halo as wide as the kernel's reach, so that the stencils never
+        #  need to check for edges.  Rows are padded to a multiple of 64 cells
+        #  and the buffer is 64-byte aligned, to help with vectorization.
+        #  A second buffer of the same shape holds the output of each step.
+        H, W = cell_array.shape
+        (top, bottom), (left, right) = self._pad_width
+        shape = (top + H + bottom, -(-(left + W + right) // 64)*64)
+        self._padded = utils.aligned_empty(shape, cell_array.dtype)
+        self._padded_out = utils.aligned_empty(shape, cell_array.dtype)
+        self._padded[...] = self.edge_fill
+        self._padded_out[...] = self.edge_fill
+        self.cell_array = self._padded[top:top + H, left:left + W]
+        self._out = self._padded_out[top:top + H, left:left + W]
+        self.cell_array[...] = cell_array
+        # Indices (in the padded buffer) of the cells to copy into the halo.
+        self._halo_rows = (top + np.arange(-top, 0) % H,
+            top + np.arange(H, H + bottom) % H)
+        self._halo_cols = (left + np.arange(-left, 0) % W,
+            left + np.arange(W, W + right) % W)
 
     def copy_state(self):
+        if self.device == "cuda":
+            return self.cell_array.copy_to_host()
         return np.copy(self.cell_array)
 
+    def run(self, n):
+        ''' Perform n steps of the automaton, without copying out any of the
+        intermediate states. '''
+        for i in range(n):
+            self.step()
+
     def n_generations(self, n=-1):
         ''' A generator, possibly useful for live animation etc.
         It will return successive states of the cellular automaton, 
@@ -99,12 +273,14 @@ class LifeLike(ConvCA):
             live = [int(char) for char in m.group(1)] # Born
             survive = [int(char) for char in m.group(2)] # Survive
         living = live + [weight_sum + 1 + i for i in survive]
+        # Use uint8, since states are always 0 or 1.
         update_array = np.array([1 if i in living else 0 for 
-            i in range(2*(weight_sum+1))])
+            i in range(2*(weight_sum+1))], dtype=np.uint8)
 
         return update_array, kernel
             
-    def __init__(self, rule_string, edges="wrap",edge_fill=0,r=1,weights=None):
+    def __init__(self, rule_string, edges="wrap",edge_fill=0,r=1,weights=None,
+            device="cpu"):
         ''' Rule_string should be in the "B/S" format 
         (e.g. "B3/S23", "3/23", or [[3],[2,3]] for Conway's Game of Life).
         
@@ -112,14 +288,128 @@ class LifeLike(ConvCA):
         can be specified (this overrides the radius param) allowing both
         "weighted" variations of life, as well as neighbourhoods other than
         the Moore neighbourhood. The array of weights must be square, and the
-        centre weight will be disregarded.'''
+        centre weight will be disregarded.
+
+        See ConvCA for the device parameter.'''
         update_array, kernel = LifeLike.parse(rule_string,r,weights)
         ConvCA.__init__(self,update_array,kernel,
-            edges=edges,edge_fill=edge_fill)
+            edges=edges,edge_fill=edge_fill,device=device)
+        # Recover the (weighted) neighbour counts for birth and survival.
+        weight_sum = int(self.kernel[r,r]) - 1
+        self.born = [n for n in range(weight_sum + 1) if update_array[n]]
+        self.survive = [n for n in range(weight_sum + 1)
+            if update_array[weight_sum + 1 + n]]
+        # Unweighted rules can use a kernel specialized to the rule, which is
+        #  compiled the first time it's needed.
+        if _kernels is not None and not weights and device == "cpu":
+            self._rule_key = (self.born, self.survive, r)
+        else:
+            self._rule_key = None
+        self._step_fn = None
+
+    def step(self):
+        ''' Perform one step of the automaton. '''
+        if self._rule_key is None:
+            ConvCA.step(self)
+            return
+        if self._step_fn is None:
+            self._step_fn = _kernels.lifelike_step(*self._rule_key)
+        self._refresh_halo()
+        H, W = self.cell_array.shape
+        top, left = self._pad_width[0][0], self._pad_width[1][0]
+        self._step_fn(self._padded, top, left, H, W, self._padded_out)
+        self._swap_buffers()
         
+class LifeLikeBitpacked(LifeLike):
+    ''' Bit-packed implementation of Lifelike cellular automata.
+
+    Cells are stored 64 to a 64-bit word, and neighbours are counted using
+    bitwise full adders, so that every operation updates 64 cells at once.
+    This uses much less memory than LifeLike, and is usually faster for
+    large grids.
+
+    Only the standard Moore neighbourhood (radius 1, no weights) is
+    supported, and edge_fill must be 0 or 1.'''
+    def __init__(self, rule_string, edges="wrap",edge_fill=0):
+        ''' Rule_string should be in the "B/S" format
+        (e.g. "B3/S23", "3/23", or [[3],[2,3]] for Conway's Game of Life).'''
+        if edge_fill not in [0,1]:
+            raise ValueError("Invalid edge fill: %s" % edge_fill)
+        LifeLike.__init__(self,rule_string,edges=edges,edge_fill=edge_fill)
+        self.width = None
+        self._mask = None
+
+    def set_state(self, cell_array):
+        '''Set the state of the cellular automaton to match the given array.'''
+        cell_array = self._check_states(cell_array)
+        self.width = cell_array.shape[1]
+        self.cell_array = utils.pack_bits(cell_array)
+        # Mask of the bits in each row that represent actual cells.
+        self._mask = utils.pack_bits(np.ones((1,self.width)))[0]
+
+    def copy_state(self):
+        return utils.unpack_bits(self.cell_array, self.width)
+
+    def _shift_rows(self, rows):
+        ''' Return two arrays in which each cell's bit holds the state of the
+        neighbour above it and below it, respectively.'''
+        if self.edges == "wrap":
+            return np.roll(rows,1,axis=0), np.roll(rows,-1,axis=0)
+        fill_row = self._mask*np.uint64(self.edge_fill)
+        north = np.empty_like(rows)
+        north[0] = fill_row
+        north[1:] = rows[:-1]
+        south = np.empty_like(rows)
+        south[-1] = fill_row
+        south[:-1] = rows[1:]
+        return north, south
+
+    @classmethod
+    def _full_add(cls, a, b, c):
+        ''' Bitwise full adder, returning (sum, carry).'''
+        partial = a ^ b
+        return partial ^ c, (a & b) | (partial & c)
+
+    def step(self):
+        ''' Perform one step of the automaton. '''
+        rows = self.cell_array
+        west, east = utils.shift_packed(rows, self.width,
+            self.edges == "wrap", self.edge_fill)
+        north, south = self._shift_rows(rows)
+        north_west, south_west = self._shift_rows(west)
+        north_east, south_east = self._shift_rows(east)
+
+        # Add up the 8 neighbours into a 4-bit count (bits0 to bits3).
+        s_a, c_a = self._full_add(west, east, north)
+        s_b, c_b = self._full_add(south, north_west, north_east)
+        s_c, c_c = south_west ^ south_east, south_west & south_east
+        bits0, carry = self._full_add(s_a, s_b, s_c)
+        t_0, t_1 = self._full_add(c_a, c_b, c_c)
+        bits1, t_2 = t_0 ^ carry, t_0 & carry
+        bits2, bits3 = t_1 ^ t_2, t_1 & t_2
+        count_bits = [bits0, bits1, bits2, bits3]
+
+        def count_equals(n):
+            result = np.zeros_like(rows)
+            result |= self._mask
+            for k, bits in enumerate(count_bits):
+                result &= bits if (n >> k) & 1 else ~bits
+            return result
+
+        born = np.zeros_like(rows)
+        for n in self.born:
+            born |= count_equals(n)
+        survive = np.zeros_like(rows)
+        for n in self.survive:
+            survive |= count_equals(n)
+        self.cell_array = (born & ~rows) | (survive & rows)
+
 class ECA(ConvCA):
     ''' Implementation of "Wolfram's Rule [n]" elementary cellular 
-    automata. '''
+    automata.
+
+    The state is stored bit-packed, 64 cells to a 64-bit word, and each
+    generation is computed with bitwise operations on whole words.'''
     def __init__(self,n,edges="wrap",edge_fill=0):
         ''' Create the elementary cellular automaton corresponding to the
         integer n, 0 <= n <= 255. '''
@@ -127,6 +417,8 @@ class ECA(ConvCA):
             raise TypeError("Not a valid rule: %s" % n)
         if n > 255 or n < 0:
             raise ValueError("Not a valid rule: %s" % n)
+        if edge_fill not in [0,1]:
+            raise ValueError("Invalid edge fill: %s" % edge_fill)
 
         # Define the appropriate "Wolfram's rule n"
         update_array = np.array([int(digit) 
@@ -136,16 +428,42 @@ class ECA(ConvCA):
         ConvCA.__init__(self,update_array,kernel,
             edges=edges,edge_fill=edge_fill)
 
+        # Precompute the (left, centre, right) patterns, encoded as in the
+        #  update array, that need to be checked for.  If most patterns lead
+        #  to a live cell, it's cheaper to check for the ones that don't.
+        self._invert = update_array.sum() > 4
+        self._patterns = [k for k in range(8)
+            if update_array[k] != self._invert]
+        self.width = None
+        self._mask = None
+
     # Note: need to override set_state and copy_state to handle the conversion
-    #  from 1d to 2d and vice-versa.
+    #  from 1d to bit-packed and vice-versa.
     def set_state(self, cell_array):
         ''' Set the state of the cellular automaton to match the 
-        given array (and convert from 1d to 2d).'''
-        self.cell_array = np.copy([cell_array])
+        given array (and convert from 1d to bit-packed).'''
+        cell_array = self._check_states(cell_array)
+        self.width = len(cell_array)
+        self.cell_array = utils.pack_bits([cell_array])
+        self._mask = utils.pack_bits(np.ones((1,self.width)))
 
     def copy_state(self):
         ''' Return current state (first convert to 1d) '''
-        return np.copy(self.cell_array[0])
+        return utils.unpack_bits(self.cell_array, self.width)[0]
+
+    def step(self):
+        ''' Perform one step of the automaton. '''
+        centre = self.cell_array
+        left, right = utils.shift_packed(centre, self.width,
+            self.edges == "wrap", self.edge_fill)
+        result = np.zeros_like(centre)
+        for k in self._patterns:
+            result |= ((left if k & 4 else ~left)
+                & (centre if k & 2 else ~centre)
+                & (right if k & 1 else ~right))
+        if self._invert:
+            result = ~result
+        self.cell_array = result & self._mask
 
 
 class NonTotalistic(ConvCA):
@@ -163,19 +481,22 @@ class NonTotalistic(ConvCA):
         return utils.nb_patterns[nb]*exponentiated
 
     @classmethod
-    def parse_rule(cls,rule,base,nb):
+    def parse_rule(cls,rule,base,nb,batched=False):
         ''' nb is the type of neighbourhood to use. '''
         if callable(rule):
-            return utils.func_to_update_array(rule, base, nb)
+            return utils.func_to_update_array(rule, base, nb, batched=batched)
         else:
             # We make the dangerous assumption that this is an update array.
             return rule
 
-    def __init__(self,rule,base=2,nb="moore",edges="wrap",edge_fill=0):
+    def __init__(self,rule,base=2,nb="moore",edges="wrap",edge_fill=0,
+            batched=False,device="cpu"):
         '''Define a non-totalistic cellular automaton.
 
         "base" is the number of possible states. "nb" is the type of
-        neighbourhood to use.  "rule" is an update function.
+        neighbourhood to use.  "rule" is an update function.  If "batched" is
+        True, the rule is applied to an array of all possible neighbourhoods at
+        once (see utils.func_to_update_array).
 
         Note that the rule is precomputed ahead of time, so probabilistic
         rules will not work.  Note also that the time efficiency of the update
@@ -184,9 +505,11 @@ class NonTotalistic(ConvCA):
         base b totalistic cellular automaton using the Moore neighbourhood
         is O(b^9), or O(b^5) if using the Von Neumann neighbourhood, so be
         careful not to use too large of a base.
+
+        See ConvCA for the device parameter.
         '''
         kernel = NonTotalistic.parse_kernel(base,nb)
-        update_array = NonTotalistic.parse_rule(rule,base,nb)
+        update_array = NonTotalistic.parse_rule(rule,base,nb,batched)
         ConvCA.__init__(self,update_array,kernel,
-            edges=edges,edge_fill=edge_fill)
+            edges=edges,edge_fill=edge_fill,device=device)
         
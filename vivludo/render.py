@@ -28,26 +28,97 @@ def scale_image(ar,n):
     replacing each cell with an n by n square of cells.
 
     This is useful if you don't want each cell of your cellular automaton
-    picture to appear larger than 1 pixel. '''
-    return ar.repeat(n,axis=0).repeat(n,axis=1)
+    picture to appear larger than 1 pixel.
+
+    Also works for 3d arrays (e.g. rgb images), scaling the first two axes.'''
+    shape = ar.shape
+    # Fill the result through a view that gives each cell its own n by n
+    #  block, so that the only allocation is the (always fresh) output.
+    out = np.empty((shape[0]*n,shape[1]*n) + shape[2:],dtype=ar.dtype)
+    out.reshape((shape[0],n,shape[1],n) + shape[2:])[...] = \
+        ar[:,None,:,None,...]
+    return out
+
+def _deduped_frames(ca,num_frames,max_period=16):
+    ''' Return a list of the first num_frames states of ca, in which repeated
+    states are the same array object rather than copies.
+
+    Since the automata are deterministic, once a state repeats one of the
+    last max_period states the rest of the frames must follow the same cycle,
+    so they are filled in without running the automaton any further.'''
+    frames = []
+    hashes = []
+    recent = {} # Hash of each recent state -> its index in frames
+    for i,f in enumerate(ca.n_generations(num_frames)):
+        h = hash(f.tobytes())
+        j = recent.get(h)
+        if j is not None and np.array_equal(frames[j],f):
+            cycle = frames[j:]
+            frames += [cycle[k % len(cycle)] for k in range(num_frames - i)]
+            break
+        frames.append(f)
+        hashes.append(h)
+        recent[h] = i
+        old = i - max_period
+        if old >= 0 and recent.get(hashes[old]) == old:
+            del recent[hashes[old]]
+    return frames
 
 def make_gif(ca,num_frames,colors=8,frame_duration=0.1, filename="./ca.gif",
-        reverse_loop=False,subrectangles=False,palette_size=256,scale=1):
+        reverse_loop=False,subrectangles=False,palette_size=256,scale=1,
+        dedupe=False):
     ''' Render a gif of the given cellular automaton ca.
     
-    Filename must have .gif extension.'''
+    Filename must have .gif extension.
+
+    If dedupe is True, runs of identical frames are written as a single frame
+    with a longer duration, and the automaton stops being run once it reaches
+    a still life or a short cycle.  (The uncoloured frames are kept in memory
+    until the gif is written, as with reverse_loop.)'''
     if type(colors) == int:
         colors = np.array(get_palette(colors),dtype=np.uint8)
     else:
         colors = np.array(colors,dtype=np.uint8) # unit8 for gif
-    frame_list = [colors[f] for f in ca.n_generations(num_frames)]
+    if dedupe:
+        frames = _deduped_frames(ca,num_frames)
+    elif reverse_loop:
+        # (Only the uncoloured frames are kept in memory for this.)
+        frames = list(ca.n_generations(num_frames))
+    else:
+        frames = ca.n_generations(num_frames)
     if reverse_loop:
         # Make it play forwards & backwards, creating a perfect loop in time.
-        frame_list = frame_list + list(reversed(frame_list))[1:-1]
-    if scale != 1:
-        frame_list = [scale_image(f,scale) for f in frame_list]
-    imageio.mimsave(filename, frame_list,duration=frame_duration,
-        subrectangles=subrectangles,palettesize=palette_size)
+        frames = frames + list(reversed(frames))[1:-1]
+    duration = frame_duration
+    if dedupe:
+        # Merge runs of repeated frames, which are the same object.
+        runs = []
+        for f in frames:
+            if runs and runs[-1][0] is f:
+                runs[-1][1] += 1
+            else:
+                runs.append([f,1])
+        frames = [f for f,n in runs]
+        duration = [frame_duration*n for f,n in runs]
+        if len(duration) == 1:
+            # (Pillow can't take a list of durations for a single frame.)
+            duration = duration[0]
+    # Colour and scale each frame only as it is written, rather than building
+    #  a list of every rgb frame first.  (The writer still keeps every frame
+    #  it is given until it closes, but no scaling intermediates are kept.)
+    rgb = None
+    with imageio.get_writer(filename, mode="I", duration=duration,
+            subrectangles=subrectangles,palettesize=palette_size) as writer:
+        for f in frames:
+            if scale != 1:
+                # The unscaled frame is only temporary, so reuse its buffer.
+                #  (Frames passed to the writer may be kept until it closes.)
+                if rgb is None:
+                    rgb = np.empty(f.shape + (3,), dtype=np.uint8)
+                np.take(colors,f,axis=0,out=rgb)
+                writer.append_data(scale_image(rgb,scale))
+            else:
+                writer.append_data(np.take(colors,f,axis=0))
 
 def save_image(grid,colors=8, filename="./ca.png", scale=1):
     ''' Render a still image of a grid of integers, representing each
@@ -57,7 +128,7 @@ def save_image(grid,colors=8, filename="./ca.png", scale=1):
         colors = np.array(get_palette(colors),dtype=np.uint8)
     else:
         colors = np.array(colors,dtype=np.uint8)
-    img = colors[grid]
+    img = np.take(colors,grid,axis=0)
     if scale != 1:
         img = scale_image(img,scale)
     imageio.imwrite(filename, img)
@@ -1,6 +1,5 @@
 ''' Define some functions useful for cellular automata.'''
 import numpy as np
-import itertools
 
 # Define some constants describing the various neighbourhoods available
 nb_sizes = {
@@ -54,6 +53,54 @@ def padded_base_b(x,b,length):
         digits =  digits + [0]*(length - len(digits))
     return digits
 
+def aligned_empty(shape, dtype, align=64):
+    ''' Like np.empty, but the returned array's data starts at an address
+    that is a multiple of align bytes.'''
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape))*dtype.itemsize
+    buf = np.empty(nbytes + align, dtype=np.uint8)
+    offset = -buf.ctypes.data % align
+    return buf[offset:offset + nbytes].view(dtype).reshape(shape)
+
+def pack_bits(ar):
+    ''' Pack a 2d array of 0s and 1s into rows of 64-bit words, so that
+    cell (i,j) is stored as bit j % 64 of word (i, j // 64).  Any unused
+    bits at the end of each row are set to 0.'''
+    ar = np.asarray(ar)
+    height, width = ar.shape
+    num_words = -(-width // 64)
+    bits = np.zeros((height, num_words*64), dtype=np.uint8)
+    bits[:,:width] = ar
+    packed = np.packbits(bits, axis=1, bitorder="little")
+    return packed.view("<u8").astype(np.uint64)
+
+def unpack_bits(words, width):
+    ''' Inverse of pack_bits, returning a uint8 array with the given number
+    of columns.'''
+    packed = np.ascontiguousarray(words, dtype="<u8").view(np.uint8)
+    return np.unpackbits(packed, axis=1, count=width, bitorder="little")
+
+def shift_packed(rows, width, wrap=True, fill=0):
+    ''' Given rows of cells packed by pack_bits, return two arrays in which
+    each cell's bit holds the state of its left and right neighbour,
+    respectively.  If wrap is False, cells beyond the edges have value fill.'''
+    one = np.uint64(1)
+    last_word, last_bit = divmod(width - 1, 64)
+    west = rows << one
+    west[:,1:] |= rows[:,:-1] >> np.uint64(63)
+    east = rows >> one
+    east[:,:-1] |= rows[:,1:] << np.uint64(63)
+    if wrap:
+        west_edge = (rows[:,last_word] >> np.uint64(last_bit)) & one
+        east_edge = rows[:,0] & one
+    else:
+        west_edge = east_edge = np.uint64(fill)
+    west[:,0] |= west_edge
+    east[:,last_word] |= east_edge << np.uint64(last_bit)
+    # The last cell may have been shifted into the unused bits.
+    west[:,last_word] &= ~np.uint64(0) >> np.uint64(63 - last_bit)
+    return west, east
+
 # Note: In theory every non-totalistic function that we can handle should have
 #  an integer encoding, but I'm not sure this is
 #  any more convenient than just working with update arrays themselves.
@@ -81,8 +128,31 @@ def update_array_to_int(arr,base):
         coefficient = coefficient * base
     return total
 
+def all_neighbourhoods(base, nb):
+    ''' Return an array of every possible neighbourhood in the given base,
+    in update array order (i.e. row i is the neighbourhood encoded by i).
+
+    The result has shape (base**9, 3, 3) for the Moore neighbourhood, and
+    (base**5, 5) or (base**9, 9) for Von Neumann and Extended Von Neumann,
+    with the smallest signed dtype that can hold base - 1 (usually int8).'''
+    nb = nb.lower()
+    size = nb_sizes[nb]
+    n = base**size
+    codes = np.arange(n, dtype=np.min_scalar_type(n - 1))
+    # Fill in digit k of each code, least significant first, using the
+    #  smallest dtype that holds a state.  This is the reverse of
+    #  itertools.product ordering, matching the flipped exponent patterns.
+    #  (A signed dtype is used so that numpy rules mixing the neighbourhoods
+    #  with int arrays, e.g. via np.select, can cast results back to it.)
+    nbhds = np.empty((n, size), dtype=np.min_scalar_type(-base))
+    for k in range(size):
+        nbhds[:,k] = codes // base**k % base
+    if nb == "moore":
+        nbhds = nbhds.reshape(-1,3,3)
+    return nbhds
+
 # This is the actually important function.
-def func_to_update_array(func, base, nb):
+def func_to_update_array(func, base, nb, batched=False):
     ''' Convert a function describing an update rule
     to its array representation (i.e. precompute the result for
     all possible inputs).
@@ -101,14 +171,18 @@ def func_to_update_array(func, base, nb):
     c d e f g
         h
         i
+
+    If batched is True, the function is instead called once with an array of
+    every possible input stacked along a new first axis (see
+    all_neighbourhoods), and should return a 1d array of results.  This is
+    much faster for large bases if the rule can be written using numpy.
+    To save memory, this array has a small integer dtype (usually int8), so
+    a rule doing arithmetic that could overflow it should convert it first,
+    e.g. with nbhds.astype(int).
     '''
-    nb = nb.lower()
-    size = nb_sizes[nb]
-    possibilities = itertools.product(range(base),repeat=size)
-    result = []
-    for poss in possibilities:
-        poss = np.flip(poss) # Must be reversed to match intended pattern
-        if nb=="moore":
-            poss = poss.reshape(3,3)
-        result.append(func(poss))
-    return np.array(result)
+    nbhds = all_neighbourhoods(base, nb)
+    if batched:
+        return np.asarray(func(nbhds))
+    # Each neighbourhood is passed as a platform int array, so that ordinary
+    #  arithmetic in the rule can't overflow.
+    return np.array([func(poss.astype(np.int_)) for poss in nbhds])